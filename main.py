@@ -4,20 +4,58 @@ import eventlet
 # Этот вызов должен быть выполнен ПЕРЕД ВСЕМИ ОСТАЛЬНЫМИ ИМПОРТАМИ,
 # чтобы обеспечить асинхронную работу Flask-SocketIO с Eventlet (как указано в Procfile).
 eventlet.monkey_patch() 
+# psycopg2 — C-расширение, которое eventlet не патчит сам: без этого каждый SQL-запрос
+# блокирует все гринлеты воркера на время ожидания ответа PostgreSQL.
+from psycogreen.eventlet import patch_psycopg
+patch_psycopg()
 
-import json
 import secrets
+import sqlite3
+from functools import lru_cache, wraps
+import time
+from collections import defaultdict, deque
 from datetime import datetime, timezone
 
-from flask import Flask, render_template, redirect, url_for, request, session, flash
-from flask_socketio import SocketIO, emit, join_room, leave_room, disconnect, rooms
+import orjson
+from cachetools import TTLCache
+from flask import Flask, render_template, redirect, url_for, request, session, flash, make_response
+from flask.json.provider import JSONProvider
+from jinja2 import FileSystemBytecodeCache
+from flask_socketio import SocketIO, emit, join_room, leave_room
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, insert, select
+from sqlalchemy.exc import DataError, IntegrityError
+from sqlalchemy.engine import Engine
 from flask_migrate import Migrate
+from flask_session import Session
+from flask_compress import Compress
+import redis
+from werkzeug.http import generate_etag
 from werkzeug.middleware.proxy_fix import ProxyFix
-from werkzeug.security import generate_password_hash, check_password_hash # Добавляем для использования
 
 # --- 1. Конфигурация и Инициализация ---
+# --- БЫСТРЫЙ JSON (orjson) ---
+# orjson в несколько раз быстрее стандартного json и сериализует datetime сам.
+class OrjsonProvider(JSONProvider):
+    """JSON-провайдер Flask на основе orjson"""
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+class OrjsonSocketIO:
+    """Замена модуля json для python-socketio: ему нужны dumps() -> str и loads()"""
+    @staticmethod
+    def dumps(obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    @staticmethod
+    def loads(s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # ИСПРАВЛЕНИЕ ДЛЯ RAILWAY (HTTPS):
 # Это необходимо, чтобы Flask видел, что запрос пришел по HTTPS.
@@ -31,18 +69,73 @@ if os.environ.get('DATABASE_URL'):
     # Заменяем 'postgres://' на 'postgresql://' для совместимости с новыми версиями SQLAlchemy.
     db_url = os.environ.get('DATABASE_URL').replace("postgres://", "postgresql://", 1)
     app.config['SQLALCHEMY_DATABASE_URI'] = db_url
+    # Пул соединений: pool_pre_ping проверяет соединение перед выдачей, а pool_recycle
+    # пересоздает его до того, как Railway закроет простаивающее подключение.
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': 10,
+        'max_overflow': 20,
+        'pool_pre_ping': True,
+        'pool_recycle': 1800,
+        # LIFO: чаще используются одни и те же "горячие" соединения, лишние простаивают и закрываются
+        'pool_use_lifo': True,
+        # Не ждем бесконечно: ни свободного соединения из пула, ни ответа сервера при подключении
+        'pool_timeout': 30,
+        'connect_args': {'connect_timeout': 10},
+    }
     print("INFO: Используется PostgreSQL.")
 else:
     # Используется локальная база данных SQLite для разработки
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///site.db'
     print("INFO: Используется локальная база данных SQLite.")
 
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', secrets.token_hex(16))
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """SQLite: журнал WAL и synchronous=NORMAL вместо fsync на каждый commit"""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
+
+# Случайный ключ генерируется только если SECRET_KEY не задан (локальная разработка).
+# В продакшене ключ обязателен: иначе у каждого воркера он свой и сессии не совпадают.
+app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY') or secrets.token_hex(16)
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+# --- ШАБЛОНЫ: КЭШ БАЙТКОДА JINJA ---
+# Скомпилированные шаблоны сохраняются на диск и переиспользуются воркерами,
+# а компиляция при импорте избавляет первый запрос после деплоя от разбора шаблонов.
+# Каталог выбирает сам Jinja: личный _jinja2-cache-<uid> с правами 0700 и проверкой владельца,
+# иначе другой пользователь машины мог бы подложить свой байткод в общий каталог /tmp.
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
+for template_name in app.jinja_env.list_templates():
+    app.jinja_env.get_template(template_name)
+
+# --- СЖАТИЕ ОТВЕТОВ ---
+# HTML страниц (особенно chat.html с историей) отдается в gzip/br, если браузер это поддерживает.
+# События SocketIO идут мимо Flask: websocket-транспорт eventlet сжимает их сам (permessage-deflate).
+Compress(app)
+
+# --- СЕССИИ НА СТОРОНЕ СЕРВЕРА (Redis) ---
+# Если задан REDIS_URL, данные сессии хранятся в Redis, а в cookie остается только
+# короткий идентификатор сессии. Без Redis используются стандартные подписанные cookie.
+REDIS_URL = os.environ.get('REDIS_URL')
+redis_client = redis.from_url(REDIS_URL) if REDIS_URL else None
+
+if redis_client is not None:
+    app.config['SESSION_TYPE'] = 'redis'
+    app.config['SESSION_REDIS'] = redis_client
+    app.config['SESSION_PERMANENT'] = False
+    Session(app)
+    print("INFO: Сессии хранятся в Redis.")
+
 db = SQLAlchemy(app)
 migrate = Migrate(app, db)
-socketio = SocketIO(app, async_mode='eventlet', cors_allowed_origins="*") # cors_allowed_origins="*" для работы с SocketIO в Production
+# message_queue=REDIS_URL позволяет нескольким воркерам рассылать события в общие комнаты.
+# max_http_buffer_size отсекает слишком большие пакеты еще на транспортном уровне.
+socketio = SocketIO(app, async_mode='eventlet', cors_allowed_origins="*", message_queue=REDIS_URL, json=OrjsonSocketIO,
+                    max_http_buffer_size=8192) # cors_allowed_origins="*" для работы с SocketIO в Production
 
 # --- 2. Модели базы данных ---
 class User(db.Model):
@@ -61,8 +154,18 @@ class Message(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     room_name = db.Column(db.String(100), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    # Имя автора хранится и в самом сообщении: история не подгружает User для каждой строки
+    username = db.Column(db.String(80), nullable=False)
     content = db.Column(db.String(500), nullable=False)
-    timestamp = db.Column(db.DateTime, index=True, default=datetime.now(timezone.utc))
+    # Время ставит сама БД, если его не передали. Прежний default=datetime.now(...)
+    # вычислялся один раз при импорте, и все такие строки получали одно и то же время.
+    timestamp = db.Column(db.DateTime, server_default=db.func.now())
+
+    # Составной индекс: история комнаты читается по room_name от новых к старым,
+    # поэтому PostgreSQL берет первые HISTORY_LIMIT строк прямо из индекса, без сортировки.
+    # Индекс строится из столбцов, а не из db.text(): так его видит автогенерация
+    # миграций и не предлагает удалить и создать заново.
+    __table_args__ = (db.Index('ix_message_room_name_timestamp', room_name, timestamp.desc()),)
 
     user = db.relationship('User', backref=db.backref('messages', lazy=True))
 
@@ -70,9 +173,341 @@ class Message(db.Model):
         return f'<Message {self.content[:20]} in {self.room_name}>'
 
 # --- 3. Глобальные словари для отслеживания состояния ---
-user_room_map = {}
-typing_users_in_rooms = {}
-ROOM_LIST = ["PythonDev", "General", "Random", "Frontend", "Backend"]
+# Если подключен Redis, состояние хранится в нем и доступно всем воркерам.
+# Словари ниже используются только при запуске без Redis (один процесс).
+# TTLCache ограничивает их размер и сам удаляет записи, пропущенные при отключении.
+ROOM_LIST = ("PythonDev", "General", "Random", "Frontend", "Backend") # Кортеж создается один раз при импорте, а не на каждый запрос
+ROOM_SET = frozenset(ROOM_LIST) # Для проверки "комната существует?" за O(1); порядок для шаблонов хранит ROOM_LIST
+USER_ROOM_TTL = 3600 # Сокет, молчащий дольше этого (сек.), теряет комнату и должен войти заново
+TYPING_TTL = 10 # Через столько секунд "зависший" индикатор печати удаляется сам
+HISTORY_LIMIT = 50 # Сколько последних сообщений комнаты показываем при входе
+MAX_MESSAGE_LENGTH = 500 # Совпадает с длиной столбца Message.content
+TYPING_DEBOUNCE = 1.0 # Повторное "печатает" от сокета рассылаем не чаще этого (сек.)
+user_room_map = TTLCache(maxsize=100000, ttl=USER_ROOM_TTL)
+typing_users_in_rooms = defaultdict(lambda: TTLCache(maxsize=10000, ttl=TYPING_TTL)) # room -> {username: True}
+room_history_cache = {} # room -> deque последних HISTORY_LIMIT сообщений
+last_typing_emit = TTLCache(maxsize=100000, ttl=TYPING_DEBOUNCE) # sid, недавно разославшие "печатает"
+# sid, последним разославшие "печатает" (и с Redis: сокет живет в одном процессе). Без TTL:
+# запись в списке печатающих истекает через TYPING_TTL, а остановку разослать все равно нужно.
+typing_sids = set()
+RATE_LIMIT_MESSAGES = 20 # Не больше стольких сообщений от пользователя...
+RATE_LIMIT_WINDOW = 10 # ...за это число секунд
+message_counts = TTLCache(maxsize=100000, ttl=RATE_LIMIT_WINDOW) # (username, номер окна) -> число сообщений
+
+# В Redis — отдельный ключ на сокет со сроком USER_ROOM_TTL, как у TTLCache: запись сокета,
+# чей disconnect так и не выполнился (падение или перезапуск воркера), истекает сама.
+def set_user_room(sid, room):
+    """Запоминает, в какой комнате находится сокет"""
+    if redis_client is not None:
+        redis_client.set(f'user_room:{sid}', room, ex=USER_ROOM_TTL)
+    else:
+        user_room_map[sid] = room
+
+def get_user_room(sid):
+    """Возвращает комнату сокета или None"""
+    if redis_client is not None:
+        key = f'user_room:{sid}'
+        pipe = redis_client.pipeline()
+        pipe.get(key)
+        pipe.expire(key, USER_ROOM_TTL) # Продлеваем TTL активного сокета (GETEX есть только с Redis 6.2)
+        room, _ = pipe.execute()
+        return room.decode() if room else None
+    room = user_room_map.get(sid)
+    if room is not None:
+        user_room_map[sid] = room # Продлеваем TTL активного сокета
+    return room
+
+def pop_user_room(sid):
+    """Удаляет сокет из карты комнат и возвращает его комнату"""
+    if redis_client is not None:
+        key = f'user_room:{sid}'
+        pipe = redis_client.pipeline()
+        pipe.get(key)
+        pipe.delete(key)
+        room, _ = pipe.execute()
+        return room.decode() if room else None
+    return user_room_map.pop(sid, None)
+
+def allow_message(username):
+    """Счетчик сообщений пользователя в текущем окне RATE_LIMIT_WINDOW. False — лимит исчерпан"""
+    if redis_client is not None:
+        key = f'rl:{username}'
+        # SET NX EX и INCR в одной транзакции MULTI: новый ключ сразу создается со сроком жизни,
+        # поэтому счетчик без срока (и вечная блокировка пользователя) невозможен. NX — окно
+        # не продлевается каждым сообщением. EXPIRE ... NX не подходит: он есть только с Redis 7.
+        pipe = redis_client.pipeline()
+        pipe.set(key, 0, ex=RATE_LIMIT_WINDOW, nx=True)
+        pipe.incr(key)
+        _, count = pipe.execute()
+    else:
+        key = (username, int(time.time() // RATE_LIMIT_WINDOW))
+        count = message_counts[key] = message_counts.get(key, 0) + 1
+    return count <= RATE_LIMIT_MESSAGES
+
+def update_typing(room, username, is_typing):
+    """Обновляет список печатающих в комнате.
+
+    Возвращает (changed, typing_users): changed — изменилось ли состояние пользователя.
+    """
+    if redis_client is not None:
+        key = f'typing:{room}'
+        pipe = redis_client.pipeline()
+        if is_typing:
+            pipe.sadd(key, username)
+            pipe.expire(key, TYPING_TTL)
+        else:
+            pipe.srem(key, username)
+        pipe.smembers(key)
+        results = pipe.execute()
+        return bool(results[0]), sorted(m.decode() for m in results[-1])
+
+    typing_users = typing_users_in_rooms[room]
+    changed = (username in typing_users) != is_typing
+    if is_typing:
+        typing_users[username] = True
+    else:
+        typing_users.pop(username, None)
+    return changed, sorted(typing_users)
+
+def format_time(dt):
+    """Время сообщения в виде 'ЧЧ:ММ' (без strftime — он заметно медленнее)"""
+    return f'{dt.hour:02d}:{dt.minute:02d}'
+
+def load_room_history(room):
+    """Последние HISTORY_LIMIT сообщений комнаты (от старых к новым).
+
+    Сначала читаем кэш (Redis или память процесса); к базе обращаемся только при промахе.
+    """
+    if redis_client is not None:
+        raw = redis_client.lrange(f'room:{room}:hist', 0, HISTORY_LIMIT - 1)
+        if raw:
+            return [orjson.loads(item) for item in reversed(raw)]
+    elif room in room_history_cache:
+        return list(room_history_cache[room])
+    return warm_room_history(room)
+
+def warm_room_history(room):
+    """Читает историю комнаты из БД и кладет ее в кэш, только если кэш еще пуст.
+
+    Сообщение попадает в БД с задержкой (фоновая запись), поэтому чтение из БД может
+    оказаться старее кэша: его заполнил push_room_history, пока мы ждали ответа базы.
+    Такой кэш не перезаписываем.
+    """
+    # Выбираем только нужные столбцы: строки приходят кортежами, без создания объектов Message
+    rows = db.session.execute(
+        select(Message.username, Message.content, Message.timestamp)
+        .where(Message.room_name == room)
+        .order_by(Message.timestamp.desc())
+        .limit(HISTORY_LIMIT)
+    ).all()
+    history = [
+        {'msg': content, 'username': username, 'time': format_time(timestamp)}
+        for username, content, timestamp in reversed(rows)
+    ]
+
+    if redis_client is None:
+        return list(room_history_cache.setdefault(room, deque(history, maxlen=HISTORY_LIMIT)))
+    if history:
+        key = f'room:{room}:hist'
+        with redis_client.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                if not pipe.exists(key):
+                    pipe.multi()
+                    pipe.rpush(key, *(orjson.dumps(item) for item in reversed(history)))
+                    pipe.execute()
+            except redis.WatchError:
+                pass # Кэш успел заполнить другой запрос — он не старее нашего чтения
+    return history
+
+def push_room_history(room, message_data):
+    """Добавляет новое сообщение в кэш истории комнаты.
+
+    Холодный кэш сначала прогревается из БД: нового сообщения там еще нет, и оно
+    добавляется сверху. Иначе следующий прогрев из БД, сделанный до фоновой записи,
+    потерял бы это сообщение в кэше.
+    """
+    if redis_client is None:
+        if room not in room_history_cache:
+            warm_room_history(room)
+        room_history_cache[room].append(message_data) # deque(maxlen) сам отбрасывает самое старое
+        return
+    key = f'room:{room}:hist'
+    pipe = redis_client.pipeline()
+    pipe.lpushx(key, orjson.dumps(message_data))
+    pipe.ltrim(key, 0, HISTORY_LIMIT - 1)
+    pushed, _ = pipe.execute()
+    if not pushed:
+        warm_room_history(room)
+        # LPUSH, а не LPUSHX: у пустой комнаты кэша нет и после прогрева
+        pipe.lpush(key, orjson.dumps(message_data))
+        pipe.ltrim(key, 0, HISTORY_LIMIT - 1)
+        pipe.execute()
+
+# --- Фоновая запись сообщений в БД ---
+# Обработчик сначала рассылает сообщение комнате, а commit выполняет отдельный гринлет,
+# чтобы медленная запись в PostgreSQL не задерживала доставку.
+# С Redis очередь — список 'chat:pending', разбирать его может любой воркер. Забранная пачка
+# не удаляется, а переносится в список обработки этого воркера и удаляется только после commit:
+# если воркер убит посреди записи (например, при деплое), пачку вернет в очередь другой.
+# Без Redis — очередь в памяти процесса.
+write_queue = eventlet.queue.Queue(maxsize=10000)
+PENDING_KEY = 'chat:pending'
+WRITER_ID = secrets.token_hex(8)
+PROCESSING_KEY = f'chat:processing:{WRITER_ID}' # Пачка, которую этот воркер сейчас сохраняет
+WRITER_ALIVE_KEY = f'chat:writer:{WRITER_ID}' # Пока ключ жив, список обработки воркера не трогаем
+WRITER_ALIVE_TTL = 60 # Больше, чем может занять одна попытка записи (pool_timeout + connect_timeout)
+WRITE_POLL_TIMEOUT = 10 # Пустая очередь: так часто (сек.) продлеваем WRITER_ALIVE_KEY
+WRITE_BATCH_SIZE = 100 # Максимум строк в одном INSERT
+WRITE_FLUSH_INTERVAL = 0.1 # Столько секунд копим сообщения после первого, прежде чем делать commit
+WRITE_RETRY_DELAY = 2 # Пауза перед повтором, если Redis или БД недоступны (сек.)
+# Конструкция INSERT создается один раз; скомпилированный SQL SQLAlchemy берет из своего кэша
+INSERT_MESSAGE = insert(Message)
+
+def enqueue_message(row):
+    """Ставит сообщение в очередь на запись в БД"""
+    if redis_client is not None:
+        # Новые — в голову списка, воркер забирает самые старые с хвоста (RPOPLPUSH)
+        redis_client.lpush(PENDING_KEY, orjson.dumps(row))
+    else:
+        # put() на полной очереди заблокировал бы обработчик: пока БД недоступна, db_writer
+        # держит пачку для повтора и очередь не разбирает. Лучше потерять запись, чем зависнуть.
+        try:
+            write_queue.put_nowait(row)
+        except eventlet.queue.Full:
+            print(f"Очередь записи в БД переполнена, сообщение не будет сохранено: {row['content'][:20]}")
+
+def next_write_batch():
+    """Ждет хотя бы одно сообщение и забирает вместе с ним накопившиеся за WRITE_FLUSH_INTERVAL.
+
+    С Redis возвращает пустой список, если за WRITE_POLL_TIMEOUT сообщений не было.
+    """
+    if redis_client is None:
+        rows = [write_queue.get()]
+        # Короткое окно: один commit (fsync в PostgreSQL) приходится на всю пачку, а не на каждое сообщение
+        eventlet.sleep(WRITE_FLUSH_INTERVAL)
+        while len(rows) < WRITE_BATCH_SIZE and not write_queue.empty():
+            rows.append(write_queue.get_nowait())
+        return rows
+
+    redis_client.set(WRITER_ALIVE_KEY, 1, ex=WRITER_ALIVE_TTL)
+    # Непустой список обработки — несохраненный остаток прошлой пачки: повторяем его.
+    # RPOPLPUSH кладет в голову, поэтому там новые сверху; разворачиваем от старых к новым.
+    raw = redis_client.lrange(PROCESSING_KEY, 0, -1)[::-1]
+    if not raw:
+        # RPOPLPUSH, а не LMOVE/BLMOVE: те есть только с Redis 6.2
+        first = redis_client.brpoplpush(PENDING_KEY, PROCESSING_KEY, timeout=WRITE_POLL_TIMEOUT)
+        if first is None:
+            return []
+        eventlet.sleep(WRITE_FLUSH_INTERVAL)
+        # Каждый RPOPLPUSH атомарен: несколько воркеров не заберут одно сообщение дважды
+        pipe = redis_client.pipeline()
+        for _ in range(WRITE_BATCH_SIZE - 1):
+            pipe.rpoplpush(PENDING_KEY, PROCESSING_KEY)
+        raw = [first, *(item for item in pipe.execute() if item is not None)]
+
+    rows = [orjson.loads(item) for item in raw]
+    for row in rows:
+        row['timestamp'] = datetime.fromisoformat(row['timestamp'])
+    return rows
+
+def finish_write_batch(retry_count):
+    """Удаляет сохраненные строки из списка обработки.
+
+    Несохраненные — последние retry_count строк пачки, они же первые в списке — остаются
+    в нем, и следующий next_write_batch повторит их.
+    """
+    if retry_count:
+        redis_client.ltrim(PROCESSING_KEY, 0, retry_count - 1)
+    else:
+        redis_client.delete(PROCESSING_KEY)
+
+def recover_orphaned_batches():
+    """Возвращает в очередь пачки воркеров, остановившихся до commit (их WRITER_ALIVE_KEY истек)"""
+    for key in redis_client.scan_iter('chat:processing:*'):
+        writer_id = key.decode().rsplit(':', 1)[1]
+        if writer_id == WRITER_ID or redis_client.exists(f'chat:writer:{writer_id}'):
+            continue
+        moved = 0
+        while redis_client.rpoplpush(key, PENDING_KEY) is not None:
+            moved += 1
+        if moved:
+            print(f"Возвращено в очередь {moved} несохраненных сообщений остановленного воркера")
+
+def save_rows(rows):
+    """Сохраняет пачку одним INSERT. Возвращает строки, которые нужно повторить позже.
+
+    Если БД отвергла пачку из-за данных (например, user_id удаленного пользователя),
+    пишем строки по одной и теряем только плохие, а не всю пачку.
+    """
+    try:
+        # Core INSERT без unit-of-work ORM: объекты Message нам не нужны
+        db.session.execute(INSERT_MESSAGE, rows)
+        db.session.commit()
+        return []
+    except (IntegrityError, DataError):
+        db.session.rollback()
+    except Exception as e:
+        db.session.rollback()
+        print(f"Ошибка сохранения сообщений в БД, повтор через {WRITE_RETRY_DELAY} с: {e}")
+        return rows
+
+    for i, row in enumerate(rows):
+        try:
+            db.session.execute(INSERT_MESSAGE, row)
+            db.session.commit()
+        except (IntegrityError, DataError) as e:
+            db.session.rollback()
+            print(f"Сообщение отброшено, БД его не принимает: {e}")
+        except Exception as e:
+            db.session.rollback()
+            print(f"Ошибка сохранения сообщений в БД, повтор через {WRITE_RETRY_DELAY} с: {e}")
+            return rows[i:]
+    return []
+
+def db_writer():
+    """Бесконечный цикл: забирает сообщения из очереди и сохраняет их в БД пачками.
+
+    Ошибка Redis или БД не должна останавливать единственный гринлет записи: пачка,
+    которую не удалось сохранить, остается в списке обработки (без Redis — в retry_rows),
+    и после паузы WRITE_RETRY_DELAY попытка повторяется.
+    """
+    retry_rows = []
+    last_recovery = 0.0
+    while True:
+        try:
+            if redis_client is not None and time.monotonic() - last_recovery > WRITER_ALIVE_TTL:
+                recover_orphaned_batches()
+                last_recovery = time.monotonic()
+            rows = retry_rows or next_write_batch()
+            if not rows:
+                continue
+            with app.app_context():
+                failed = save_rows(rows)
+            if redis_client is not None:
+                # Если Redis упадет до этого шага, пачка будет записана повторно: дубль лучше потери
+                finish_write_batch(len(failed))
+            else:
+                retry_rows = failed
+            if failed:
+                eventlet.sleep(WRITE_RETRY_DELAY)
+        except Exception as e:
+            # Redis недоступен (BRPOPLPUSH, конвейер или список обработки): ждем и пробуем снова
+            print(f"Ошибка фоновой записи сообщений, повтор через {WRITE_RETRY_DELAY} с: {e}")
+            eventlet.sleep(WRITE_RETRY_DELAY)
+
+db_writer_started = False
+
+def start_db_writer():
+    """Запускает фоновую запись один раз на процесс.
+
+    Не при импорте: main импортируют и `flask db upgrade`, и `flask shell`, и запущенный
+    там потребитель мог бы забрать сообщение из 'chat:pending' и завершиться, не сохранив его.
+    """
+    global db_writer_started
+    if not db_writer_started:
+        db_writer_started = True
+        socketio.start_background_task(db_writer)
 
 # --- 4. Маршруты (Routes) ---
 
@@ -83,28 +518,55 @@ def index():
         return redirect(url_for('login'))
     return render_template('index.html', title='Главная')
 
+@lru_cache(maxsize=1)
+def render_login():
+    """Страница входа без flash-сообщений одинакова для всех: рендерим ее один раз на процесс"""
+    return render_template('login.html', title='Вход')
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     # Ваша логика входа
-    return render_template('login.html', title='Вход')
+    if '_flashes' in session:
+        # Есть сообщения для пользователя — рендерим заново, чтобы их показать
+        return render_template('login.html', title='Вход')
+    return render_login()
+
+@app.route('/logout')
+def logout():
+    # Выход: очищаем сессию (и в Redis, и в cookie) и возвращаем на страницу входа
+    session.clear()
+    return redirect(url_for('login'))
+
+@lru_cache(maxsize=1)
+def render_room_selection():
+    """Страница выбора комнаты одинакова для всех: рендерим ее и считаем ETag один раз на процесс"""
+    html = render_template('room_selection.html', popular_rooms=ROOM_LIST, title='Выбор комнаты')
+    return html, generate_etag(html.encode())
 
 @app.route('/room_selection')
 def room_selection():
     if 'user_id' not in session:
         return redirect(url_for('login'))
-    return render_template('room_selection.html', rooms=ROOM_LIST, title='Выбор комнаты')
+    html, etag = render_room_selection()
+    response = make_response(html)
+    # Запрос с If-None-Match проверяет Flask-Compress: он дописывает к ETag ":gzip" и сам
+    # отвечает 304, поэтому своей проверки (make_conditional) здесь нет
+    response.set_etag(etag)
+    response.cache_control.private = True
+    return response
 
 @app.route('/chat/<room_name>')
-def chat(room_name):
+def chat_room(room_name):
+    # Имя функции — endpoint 'chat_room', на который ссылается room_selection.html
     if 'user_id' not in session:
         return redirect(url_for('login'))
-    if room_name not in ROOM_LIST:
+    if room_name not in ROOM_SET:
         flash('Такой комнаты не существует.', 'error')
         return redirect(url_for('room_selection'))
     
-    # Загрузка истории сообщений (исправлено)
+    # Загрузка истории сообщений (из кэша Redis или из БД)
     try:
-        messages = Message.query.filter_by(room_name=room_name).order_by(Message.timestamp.asc()).all()
+        messages = load_room_history(room_name)
     except Exception as e:
         # Это может случиться, если база данных еще не инициализирована или есть проблемы с миграцией.
         print(f"Ошибка при загрузке сообщений: {e}")
@@ -113,50 +575,129 @@ def chat(room_name):
     return render_template('chat.html', room_name=room_name, messages=messages)
 
 # --- 5. Обработчики SocketIO ---
+@socketio.on('connect')
+def on_connect():
+    # Сокеты есть только у веб-процесса: здесь и запускаем запись сообщений в БД
+    start_db_writer()
+
+def authenticated_only(f):
+    """Игнорирует события SocketIO от сокетов без вошедшего пользователя"""
+    @wraps(f)
+    def wrapped(*args, **kwargs):
+        if 'username' not in session:
+            return
+        return f(*args, **kwargs)
+    return wrapped
+
 @socketio.on('join')
+@authenticated_only
 def on_join(data):
     # Ваш код обработки присоединения
-    username = session.get('username')
+    if not isinstance(data, dict):
+        return
+    username = session['username']
     room = data.get('room')
-    if not username or not room:
+    # isinstance до поиска во frozenset: список или словарь вызвали бы TypeError
+    if not isinstance(room, str) or room not in ROOM_SET:
         return 
     
     join_room(room)
-    user_room_map[request.sid] = room
+    set_user_room(request.sid, room)
     
     emit('status', {'msg': username + ' присоединился к комнате.'}, room=room)
 
 @socketio.on('text')
+@authenticated_only
 def on_text(data):
     # Ваш код обработки текстовых сообщений
-    room = user_room_map.get(request.sid)
-    username = session.get('username')
+    # Некорректный ввод отбрасываем до любых обращений к Redis и БД
+    if not isinstance(data, dict): # Строка, байты или список вместо объекта
+        return
     content = data.get('msg')
-    
-    if not room or not username or not content:
+    if not isinstance(content, str):
+        return
+    content = content.strip() # Один раз: дальше и проверки, и сохранение работают с этой строкой
+    if not content:
+        return
+    if len(content) > MAX_MESSAGE_LENGTH:
+        # Не обрезаем молча: автор должен узнать, что сообщение не отправлено
+        emit('error_message', {'msg': f'Сообщение длиннее {MAX_MESSAGE_LENGTH} символов.'})
+        return
+
+    room = get_user_room(request.sid)
+    if not room:
+        # Запись о комнате истекает (USER_ROOM_TTL), а без Redis еще и вытесняется при переполнении
+        # карты: не теряем сообщение молча, а просим войти в комнату заново
+        emit('error_message', {'msg': 'Вы не в комнате. Обновите страницу, чтобы войти заново.'})
+        return
+    username = session['username']
+    # Без лимита один клиент может заспамить комнату: каждое сообщение — рассылка всем и запись в БД
+    if not allow_message(username):
+        emit('error_message', {'msg': 'Слишком много сообщений. Подождите несколько секунд.'})
         return
 
-    # Сохранение сообщения в БД (пример)
+    now = datetime.now(timezone.utc)
+    message_data = {'msg': content, 'username': username, 'time': format_time(now)}
+    emit('message', message_data, room=room)
+    # Кэш истории обновляем до постановки в очередь записи: прогрев кэша из БД
+    # не должен увидеть это сообщение уже записанным
     try:
-        user = User.query.filter_by(username=username).first()
-        if user:
-            new_message = Message(room_name=room, user_id=user.id, content=content)
-            db.session.add(new_message)
-            db.session.commit()
+        push_room_history(room, message_data)
     except Exception as e:
-        print(f"Ошибка сохранения сообщения в БД: {e}")
-        db.session.rollback()
+        print(f"Ошибка обновления кэша истории: {e}")
+
+    # Сохранение в БД — в фоне, после рассылки.
+    # user_id уже лежит в сессии, поэтому User из БД на каждое сообщение не читаем.
+    user_id = session.get('user_id')
+    if user_id:
+        enqueue_message({'room_name': room, 'user_id': user_id, 'username': username, 'content': content, 'timestamp': now})
+
+@socketio.on('typing')
+@authenticated_only
+def on_typing(data):
+    # Индикатор "печатает..." для комнаты
+    if not isinstance(data, dict):
+        return
+    room = get_user_room(request.sid)
+    if not room:
+        return
+    username = session['username']
+
+    is_typing = bool(data.get('typing'))
+    changed, typing_users = update_typing(room, username, is_typing)
 
+    # Изменение состояния рассылаем сразу. Повторное "печатает" (клиент продлевает запись,
+    # пока пользователь печатает) — не чаще TYPING_DEBOUNCE.
+    if is_typing:
+        if not changed and request.sid in last_typing_emit:
+            return
+        last_typing_emit[request.sid] = True
+        typing_sids.add(request.sid)
+    else:
+        # Остановку рассылаем и тогда, когда запись уже истекла по TYPING_TTL:
+        # иначе у клиентов индикатор остался бы до чужого изменения списка
+        if not changed and request.sid not in typing_sids:
+            return
+        last_typing_emit.pop(request.sid, None)
+        typing_sids.discard(request.sid)
 
-    emit('message', {'msg': content, 'username': username, 'time': datetime.now(timezone.utc).strftime('%H:%M')}, room=room)
+    # Самому печатающему его же статус не нужен
+    emit('typing_status', {'typing_users': typing_users}, room=room, skip_sid=request.sid)
 
 @socketio.on('disconnect')
 def test_disconnect():
     # Ваш код обработки отключения
-    room = user_room_map.pop(request.sid, None)
+    room = pop_user_room(request.sid)
+    last_typing_emit.pop(request.sid, None)
+    was_typing = request.sid in typing_sids
+    typing_sids.discard(request.sid)
     username = session.get('username')
     if room and username:
         leave_room(room)
+        # Убираем ушедшего из списка печатающих, иначе он "печатает" до истечения TTL
+        changed, typing_users = update_typing(room, username, False)
+        if changed or was_typing:
+            emit('typing_status', {'typing_users': typing_users}, room=room)
         emit('status', {'msg': username + ' покинул комнату.'}, room=room)
 
 # --- 6. Запуск приложения ---
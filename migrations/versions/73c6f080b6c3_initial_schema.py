@@ -0,0 +1,50 @@
+"""initial schema
+
+Revision ID: 73c6f080b6c3
+Revises:
+Create Date: 2026-10-15 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '73c6f080b6c3'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Таблицы могли быть созданы раньше через db.create_all(), без миграций:
+    # такие базы просто получают отметку этой ревизии
+    inspector = sa.inspect(op.get_bind())
+
+    if not inspector.has_table('user'):
+        op.create_table(
+            'user',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('username', sa.String(length=80), nullable=False),
+            sa.PrimaryKeyConstraint('id'),
+            sa.UniqueConstraint('username'),
+        )
+
+    if not inspector.has_table('message'):
+        op.create_table(
+            'message',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('room_name', sa.String(length=100), nullable=False),
+            sa.Column('user_id', sa.Integer(), nullable=False),
+            sa.Column('content', sa.String(length=500), nullable=False),
+            sa.Column('timestamp', sa.DateTime(), nullable=True),
+            sa.ForeignKeyConstraint(['user_id'], ['user.id']),
+            sa.PrimaryKeyConstraint('id'),
+        )
+        op.create_index('ix_message_timestamp', 'message', ['timestamp'])
+
+
+def downgrade():
+    op.drop_index('ix_message_timestamp', table_name='message')
+    op.drop_table('message')
+    op.drop_table('user')
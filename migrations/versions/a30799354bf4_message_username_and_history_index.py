@@ -0,0 +1,58 @@
+"""message username, history index, timestamp server default
+
+Revision ID: a30799354bf4
+Revises: 73c6f080b6c3
+Create Date: 2026-10-15 12:05:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a30799354bf4'
+down_revision = '73c6f080b6c3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    columns = {column['name'] for column in inspector.get_columns('message')}
+
+    # Имя автора хранится в самом сообщении. Сначала столбец допускает NULL,
+    # заполняется из user и только потом становится NOT NULL.
+    if 'username' not in columns:
+        op.add_column('message', sa.Column('username', sa.String(length=80), nullable=True))
+    # COALESCE: SQLite не проверяет внешние ключи, и у сообщения может не оказаться автора
+    op.execute(
+        'UPDATE message SET username = COALESCE('
+        '(SELECT username FROM "user" WHERE "user".id = message.user_id), \'\') '
+        'WHERE username IS NULL'
+    )
+
+    indexes = {index['name'] for index in inspector.get_indexes('message')}
+    # batch_alter_table: SQLite не умеет ALTER COLUMN и пересоздает таблицу,
+    # PostgreSQL выполняет обычные ALTER TABLE
+    with op.batch_alter_table('message') as batch_op:
+        batch_op.alter_column('username', existing_type=sa.String(length=80), nullable=False)
+        # Время ставит БД; прежний default в Python вычислялся один раз при импорте
+        batch_op.alter_column('timestamp', existing_type=sa.DateTime(),
+                              server_default=sa.text('CURRENT_TIMESTAMP'))
+        # Составной индекс (room_name, timestamp DESC) заменяет одиночный индекс по timestamp
+        if 'ix_message_timestamp' in indexes:
+            batch_op.drop_index('ix_message_timestamp')
+
+    # Проверяем заново: пересоздание таблицы в SQLite не сохраняет индексы-выражения
+    indexes = {index['name'] for index in sa.inspect(op.get_bind()).get_indexes('message')}
+    if 'ix_message_room_name_timestamp' not in indexes:
+        op.create_index('ix_message_room_name_timestamp', 'message',
+                        ['room_name', sa.text('timestamp DESC')])
+
+
+def downgrade():
+    op.drop_index('ix_message_room_name_timestamp', table_name='message')
+    with op.batch_alter_table('message') as batch_op:
+        batch_op.alter_column('timestamp', existing_type=sa.DateTime(), server_default=None)
+        batch_op.create_index('ix_message_timestamp', ['timestamp'])
+        batch_op.drop_column('username')